@@ -1,6 +1,9 @@
+import codecs
 from collections import deque
-from struct import Struct
-from typing import List, Tuple, Optional
+from functools import lru_cache
+from operator import index
+from struct import Struct, error as StructError
+from typing import Callable, Iterable, List, Tuple, Optional
 
 from ezimon.core import logger
 
@@ -8,22 +11,56 @@ from ezimon.core import logger
 # Maximum lengths of the queues used to hold (de)serialised data.
 _MAX_QUEUE_LEN = 100
 
+# Encodings (as normalised by ``codecs.lookup()``) which ``str.encode()`` and
+# ``bytes.decode()`` handle internally without going through the codec
+# registry. These are all supersets of ASCII.
+_BUILTIN_ENCODINGS = {'utf-8', 'ascii', 'iso8859-1'}
+
+
+def _utf8_complete_len(data) -> int:
+    """Returns the length of ``data`` excluding any incomplete UTF-8 character
+    at the end. Only the last few bytes are examined, and they are not fully
+    validated; that is left to the decoder.
+    """
+
+    n = len(data)
+
+    # Step back over up to 3 continuation bytes to find the lead byte of the
+    # last character, then check whether all of its bytes are present.
+    for i in range(n - 1, max(n - 4, 0) - 1, -1):
+        b = data[i]
+        if b & 0xC0 != 0x80:
+            if 0xC2 <= b < 0xE0:
+                char_len = 2
+            elif 0xE0 <= b < 0xF0:
+                char_len = 3
+            elif 0xF0 <= b < 0xF5:
+                char_len = 4
+            else:
+                break
+            return i if n - i < char_len else n
+
+    return n
+
 
 class BaseBinaryProtocol:
     """A base protocol which (de)serialises an object to/from bytes."""
 
+    __slots__ = ('_ser_q', '_deser_q')
+
     def __init__(self):
         # Double-ended queues to store (de)serialised data.
         # We use the "left" side to put items, and "right" side to pop.
-        self._ser_q = deque(maxlen=100)
-        self._deser_q = deque(maxlen=100)
+        self._ser_q = deque(maxlen=_MAX_QUEUE_LEN)
+        self._deser_q = deque(maxlen=_MAX_QUEUE_LEN)
 
     def process_data(self, data: bytes):
         """Process a chunk of data, which may result in one or more sets of
         values being placed on the deserialised queue.
 
         Subclasses should implement this and call ``submit_deserialised()`` if
-        deserialisation is completed.
+        deserialisation is completed. The protocols in this module append to
+        the queue directly instead, to avoid a method call per item.
         """
 
         raise NotImplementedError
@@ -33,7 +70,8 @@ class BaseBinaryProtocol:
         being placed on the serialised queue.
 
         Subclasses should implement this and call ``submit_serialised()`` if
-        serialisation is complete.
+        serialisation is complete. The protocols in this module append to the
+        queue directly instead, to avoid a method call per item.
         """
 
         raise NotImplementedError
@@ -54,24 +92,36 @@ class BaseBinaryProtocol:
 
         self._deser_q.appendleft(values)
 
+    def submit_serialised_many(self, items: Iterable[bytes]):
+        """Submit several items of processed serialised data at once, oldest
+        first. Cheaper than calling ``submit_serialised()`` for each.
+
+        :param items: iterable of serialised ``bytes`` objects to submit.
+        """
+
+        self._ser_q.extendleft(items)
+
+    def submit_deserialised_many(self, items: Iterable[tuple]):
+        """Submit several tuples of processed deserialised values at once,
+        oldest first. Cheaper than calling ``submit_deserialised()`` for each.
+
+        :param items: iterable of tuples of deserialised values.
+        """
+
+        self._deser_q.extendleft(items)
+
     def get_next_serialised(self) -> Optional[bytes]:
         """Retrieves the next (oldest) serialised data item in the queue and
         returns it. Returns None if there is no data in the queue.
         """
 
-        try:
-            return self._ser_q.pop()
-        except IndexError:
-            return None
+        return self._ser_q.pop() if self._ser_q else None
 
     def get_next_deserialised(self) -> Optional[tuple]:
         """Retrieves the next (oldest) tuple of deserialised values in the queue
         and returns it. Returns None if there is no items in the queue."""
 
-        try:
-            return self._deser_q.pop()
-        except IndexError:
-            return None
+        return self._deser_q.pop() if self._deser_q else None
 
 
 class StringBinaryProtocol(BaseBinaryProtocol):
@@ -81,48 +131,139 @@ class StringBinaryProtocol(BaseBinaryProtocol):
     :param encoding: encoding to use when (de)serialising. See
         https://docs.python.org/3/library/codecs.html#standard-encodings for
         available encodings. Defaults to 'utf-8'
+    :param encode_errors: error handler to use when serialising. See
+        https://docs.python.org/3/library/codecs.html#error-handlers for
+        available handlers. Defaults to 'strict', which logs an error and
+        drops the string.
+    :param decode_errors: error handler to use when deserialising. Defaults to
+        'strict', which logs an error and drops the invalid bytes. With any
+        handler, an incomplete character at the end of a chunk is held back
+        until more data arrives.
     """
 
-    def __init__(self, encoding: str = 'utf-8'):
+    __slots__ = ('encoding', 'encode_errors', 'decode_errors', '_codec_name',
+                 '_codec_encode', '_codec_decode', '_incremental_decode',
+                 '_ascii_fast_path', '_utf8', '_pending_data')
+
+    def __init__(self, encoding: str = 'utf-8', encode_errors: str = 'strict',
+                 decode_errors: str = 'strict'):
 
         super().__init__()
 
         self.encoding = encoding
+        self.encode_errors = encode_errors
+        self.decode_errors = decode_errors
+
+        # For encodings without a builtin fast path, keep hold of the codec's
+        # functions so each call avoids looking the codec up again. These are
+        # None when the builtin ``str``/``bytes`` methods should be used, in
+        # which case they are passed the normalised name so that aliases such
+        # as 'U8' also take the fast path.
+        codec = codecs.lookup(encoding)
+        self._codec_name = codec.name
+        if codec.name in _BUILTIN_ENCODINGS:
+            self._codec_encode = self._codec_decode = None
+        else:
+            self._codec_encode = codec.encode
+            self._codec_decode = codec.decode
+
+        # Handlers other than 'strict' never raise, so leave decoding to the
+        # codec's incremental decoder, which holds back incomplete characters
+        # itself. The 'strict' handler instead logs errors and carries on; see
+        # _decode().
+        if decode_errors == 'strict':
+            self._incremental_decode = None
+        else:
+            self._incremental_decode = \
+                codec.incrementaldecoder(decode_errors).decode
+
+        # Pure ASCII data can skip the general decoding machinery when the
+        # encoding is a builtin one. bytes.isascii() needs Python 3.7+.
+        self._ascii_fast_path = (self._codec_decode is None
+                                 and hasattr(bytes, 'isascii'))
+
+        # For UTF-8, incomplete characters at the end of data can be found
+        # up front rather than by catching a decode error.
+        self._utf8 = codec.name == 'utf-8'
 
         # Stores data which needs to be processed along with the next data.
-        self._pending_data = None
+        # Kept as a bytearray so it can be extended and trimmed in place.
+        self._pending_data = bytearray()
 
     def process_data(self, data: bytes):
         # Ignore empty data.
         if not data:
             return
 
-        # Append any pending data.
-        if self._pending_data is not None:
-            data = self._pending_data + data
-            self._pending_data = None
+        if self._incremental_decode is not None:
+            s = self._incremental_decode(data)
+            if s:
+                self._deser_q.appendleft((s,))
+            return
+
+        pending = self._pending_data
 
-        try:
-            s = data.decode(encoding=self.encoding, errors='strict')
-        except UnicodeDecodeError as e:
-            assert e.object == data
+        # Fast path: with nothing pending, pure ASCII data is always a complete
+        # string on its own.
+        if not pending and self._ascii_fast_path and data.isascii():
+            self._deser_q.appendleft((data.decode('ascii'),))
+            return
 
-            # Process any data before the start of the error.
-            self.process_data(data[:e.start])
+        # If there is pending data, append to it and decode from the buffer,
+        # then trim off whatever was consumed. Otherwise decode directly from
+        # the given data and only keep any unconsumed tail.
+        if pending:
+            pending.extend(data)
+            del pending[:self._decode(pending)]
+        else:
+            pending.extend(data[self._decode(data):])
 
-            # If the error occurred at the end of the data, it could be that
-            # more data still needs to arrive to decode, so set it to pending.
-            if e.end == len(data):
-                self._pending_data = data[e.start:e.end]
+    def _decode(self, data) -> int:
+        """Decode as much of ``data`` as possible, submitting the result.
 
-            # Otherwise, log an error for the part which specifically caused an
-            # error, and try and process data after.
-            else:
+        Returns the number of bytes consumed. Any remaining bytes are an
+        incomplete character which may be completed by further data.
+        """
+
+        if self._utf8:
+            end = _utf8_complete_len(data)
+            if end < len(data):
+                data = data[:end]
+
+        offset = 0
+        while offset < len(data):
+            chunk = data[offset:]
+            try:
+                if self._codec_decode is None:
+                    s = chunk.decode(self._codec_name, 'strict')
+                else:
+                    s, _ = self._codec_decode(chunk, 'strict')
+            except UnicodeDecodeError as e:
+                # Process any data before the start of the error. This is
+                # known to be valid so can be decoded directly.
+                if e.start:
+                    if self._codec_decode is None:
+                        s = chunk[:e.start].decode(self._codec_name, 'strict')
+                    else:
+                        s, _ = self._codec_decode(chunk[:e.start], 'strict')
+                    self._deser_q.appendleft((s,))
+
+                # If the error occurred at the end of the data, it could be
+                # that more data still needs to arrive to decode, so leave it
+                # pending.
+                if e.end == len(chunk):
+                    return offset + e.start
+
+                # Otherwise, log an error for the part which specifically
+                # caused an error, and carry on with the data after.
                 logger.error('failed to decode %s: %s',
-                             data[e.start:e.end], str(e))
-                self.process_data(data[e.end:])
-        else:
-            self.submit_deserialised((s,))
+                             bytes(chunk[e.start:e.end]), e)
+                offset += e.end
+            else:
+                self._deser_q.appendleft((s,))
+                break
+
+        return len(data)
 
     def process_values(self, values: tuple):
         if len(values) != 1:
@@ -130,17 +271,116 @@ class StringBinaryProtocol(BaseBinaryProtocol):
 
         s = values[0]
         try:
-            b = s.encode(encoding=self.encoding, errors='strict')
+            if self._codec_encode is None:
+                b = s.encode(self._codec_name, self.encode_errors)
+            else:
+                b, _ = self._codec_encode(s, self.encode_errors)
         except UnicodeError as e:
-            logger.error('failed to encode %s: %s', s, str(e))
+            logger.error('failed to encode %s: %s', s, e)
         else:
-            self.submit_serialised(b)
+            self._ser_q.appendleft(b)
+
+
+# Struct format codes for (type, length) field definitions.
+_STRUCT_LOOKUP = {
+    ('int', 1): 'b',
+    ('int', 2): 'h',
+    ('int', 4): 'i',
+    ('int', 8): 'q',
+    ('uint', 1): 'B',
+    ('uint', 2): 'H',
+    ('uint', 4): 'I',
+    ('uint', 8): 'Q',
+    ('bool', 1): '?',
+    ('float', 4): 'f',
+    ('float', 8): 'd'
+}
+
+
+@lru_cache(maxsize=128)
+def _compile_fields(field_definitions: Tuple[Tuple[str, int], ...]) \
+        -> Tuple[Struct, Optional[Callable], Optional[Callable]]:
+    """Compiles field definitions for ``FixedLengthBinaryProtocol``.
+
+    Returns the ``Struct`` for the whole message, along with functions to
+    convert values to and from it for integer fields which have no native
+    struct format. These functions are None if there are no such fields.
+    Results are cached so that protocols created repeatedly with the same
+    definitions share them.
+
+    :raises ValueError: if the fields have a total length of zero.
+    """
+
+    fmt_parts = ['>']
+    int_fields = []
+    for i, (type_, length) in enumerate(field_definitions):
+        try:
+            fmt_parts.append(_STRUCT_LOOKUP[(type_, length)])
+        except KeyError:
+            fmt_parts.append(f'{length}s')
+            if type_ in ('int', 'uint'):
+                int_fields.append((i, length, type_ == 'int'))
+
+    struct = Struct(''.join(fmt_parts))
+    if not struct.size:
+        raise ValueError('field definitions must have a non-zero total length')
+    if not int_fields:
+        return struct, None, None
+    return (struct,) + _make_int_converters(len(field_definitions), int_fields)
+
+
+def _int_to_bytes(value, length: int, signed: bool) -> bytes:
+    """Converts an integer to ``bytes`` for a non-native length field. Like
+    ``Struct.pack``, raises ``struct.error`` if the value is not an integer.
+    """
+
+    try:
+        value = index(value)
+    except TypeError:
+        raise StructError('required argument is not an integer') from None
+    return value.to_bytes(length, 'big', signed=signed)
+
+
+def _make_int_converters(num_fields: int,
+                         int_fields: List[Tuple[int, int, bool]]) \
+        -> Tuple[Callable, Callable]:
+    """Generates functions which convert the given integer fields of a tuple
+    of values to and from ``bytes``. The field positions and lengths are
+    written into the generated code, so no loop over the fields is needed per
+    message.
+
+    :param num_fields: total number of fields.
+    :param int_fields: ``(index, length, signed)`` for each integer field to
+        convert.
+    """
+
+    to_items = [f'v[{i}]' for i in range(num_fields)]
+    from_items = list(to_items)
+    for i, length, signed in int_fields:
+        to_items[i] = f'_to_bytes(v[{i}], {length}, {signed})'
+        from_items[i] = f'_from_bytes(v[{i}], "big", signed={signed})'
+
+    # Too few values raise struct.error here, as Struct.pack would. Any extra
+    # values are passed through so that struct reports those itself.
+    source = (
+        f'def ints_to_bytes(v, _to_bytes=_int_to_bytes):\n'
+        f'    if len(v) < {num_fields}:\n'
+        f'        raise StructError("pack expected {num_fields} items for "\n'
+        f'                          "packing (got %d)" % len(v))\n'
+        f'    return ({", ".join(to_items)}, *v[{num_fields}:])\n'
+        f'def ints_from_bytes(v, _from_bytes=int.from_bytes):\n'
+        f'    return ({", ".join(from_items)},)\n'
+    )
+    namespace = {'_int_to_bytes': _int_to_bytes, 'StructError': StructError}
+    exec(source, namespace)
+    return namespace['ints_to_bytes'], namespace['ints_from_bytes']
 
 
 class FixedLengthBinaryProtocol(BaseBinaryProtocol):
     """Protocol which (de)serialises a fixed number of fixed length fields.
 
     :param field_definitions: a list of field definitions. See below for details
+    :raises ValueError: if the fields have a total length of zero.
 
     Each field definition is a 2-tuple defining the format of each field with
     the format ``(type, length)``. ``type`` should be a string of one of the
@@ -172,28 +412,107 @@ class FixedLengthBinaryProtocol(BaseBinaryProtocol):
 
     """
 
+    __slots__ = ('_num_fields', '_struct', '_ints_to_bytes',
+                 '_ints_from_bytes', '_pending_data')
+
     def __init__(self, field_definitions: List[Tuple[str, int]]):
         super().__init__()
 
-        _struct_lookup = {
-            ('int', 1): 'b',
-            ('int', 2): 'h',
-            ('int', 4): 'i',
-            ('int', 8): 'q',
-            ('uint', 1): 'B',
-            ('uint', 2): 'H',
-            ('uint', 4): 'I',
-            ('uint', 8): 'Q',
-            ('bool', 1): '?',
-            ('float', 4): 'f',
-            ('float', 8): 'd'
-        }
-
-        fmt_parts = ['>']
-        for type_, length in field_definitions:
-            try:
-                fmt_parts.append(_struct_lookup[(type_, length)])
-            except KeyError:
-                fmt_parts.append(f'{length}s')
+        # Integer fields with no native struct format are (un)packed as bytes
+        # and converted separately; see _compile_fields().
+        fields = tuple((type_, length) for type_, length in field_definitions)
+        self._struct, self._ints_to_bytes, self._ints_from_bytes = \
+            _compile_fields(fields)
+        self._num_fields = len(fields)
+
+        # Stores the start of a message which has only partially arrived.
+        self._pending_data = bytearray()
+
+    @property
+    def size(self) -> int:
+        """Length of a serialised message in bytes."""
+
+        return self._struct.size
+
+    def serialise(self, values: tuple) -> bytes:
+        """Serialise a tuple of values to a single message.
+
+        :param values: tuple with one value per field.
+        :raises struct.error: if the values do not fit the fields.
+        :raises OverflowError: if an integer is too large for its field.
+        """
+
+        if self._ints_to_bytes:
+            values = self._ints_to_bytes(values)
+        return self._struct.pack(*values)
+
+    def serialise_into(self, buffer, offset: int, values: tuple):
+        """Serialise a tuple of values into a writable buffer, starting at
+        ``offset``. Useful to pack many messages into one preallocated buffer
+        without creating intermediate ``bytes`` objects.
 
-        self._struct = Struct(''.join(fmt_parts))
+        :param buffer: writable bytes-like object, e.g. a ``bytearray``.
+        :param offset: position in ``buffer`` to write the message to.
+        :param values: tuple with one value per field.
+        :raises struct.error: if the values do not fit the fields or buffer.
+        :raises OverflowError: if an integer is too large for its field.
+        """
+
+        if self._ints_to_bytes:
+            values = self._ints_to_bytes(values)
+        self._struct.pack_into(buffer, offset, *values)
+
+    def deserialise(self, data, offset: int = 0) -> tuple:
+        """Deserialise a single message from ``data``, starting at
+        ``offset``, without copying it out first.
+
+        :param data: bytes-like object containing the message.
+        :param offset: position of the message in ``data``.
+        :raises struct.error: if ``data`` is too short.
+        """
+
+        values = self._struct.unpack_from(data, offset)
+        if self._ints_from_bytes:
+            values = self._ints_from_bytes(values)
+        return values
+
+    def process_data(self, data: bytes):
+        # If there is pending data, append to it and unpack from the buffer,
+        # then trim off whatever was consumed. Otherwise unpack directly from
+        # the given data and only keep any partial message at the end.
+        pending = self._pending_data
+        if pending:
+            pending.extend(data)
+            del pending[:self._deserialise_all(pending)]
+        else:
+            pending.extend(data[self._deserialise_all(data):])
+
+    def _deserialise_all(self, data) -> int:
+        """Deserialise all complete messages in ``data``, submitting each.
+
+        Returns the number of bytes consumed.
+        """
+
+        size = self._struct.size
+        end = len(data) - len(data) % size
+        if end:
+            # Unpack every complete message and queue them in a single call.
+            # The iterator releases its view when exhausted, so ``data`` can
+            # be resized afterwards.
+            with memoryview(data) as view:
+                messages = self._struct.iter_unpack(view[:end])
+                if self._ints_from_bytes:
+                    messages = map(self._ints_from_bytes, messages)
+                self._deser_q.extendleft(messages)
+        return end
+
+    def process_values(self, values: tuple):
+        if len(values) != self._num_fields:
+            raise ValueError(f'values must be of length {self._num_fields}')
+
+        try:
+            b = self.serialise(values)
+        except (StructError, OverflowError) as e:
+            logger.error('failed to serialise %s: %s', values, e)
+        else:
+            self._ser_q.appendleft(b)
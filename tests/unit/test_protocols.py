@@ -1,7 +1,10 @@
+import struct
 from unittest import TestCase
 
 from ezimon.core import logger
-from ezimon.core.protocols import BaseBinaryProtocol, StringBinaryProtocol
+from ezimon.core.protocols import (_MAX_QUEUE_LEN, BaseBinaryProtocol,
+                                   FixedLengthBinaryProtocol,
+                                   StringBinaryProtocol, _utf8_complete_len)
 
 
 class TestBaseBinaryProtocol(TestCase):
@@ -25,6 +28,28 @@ class TestBaseBinaryProtocol(TestCase):
         self.assertEqual(p.get_next_deserialised(), (1, 2, 3))
         self.assertIsNone(p.get_next_deserialised())
 
+    def test_serialised_many(self):
+        p = BaseBinaryProtocol()
+        p.submit_serialised_many([b'a', b'b'])
+        p.submit_serialised(b'c')
+        self.assertEqual(p.get_next_serialised(), b'a')
+        self.assertEqual(p.get_next_serialised(), b'b')
+        self.assertEqual(p.get_next_serialised(), b'c')
+        self.assertIsNone(p.get_next_serialised())
+
+    def test_deserialised_many(self):
+        p = BaseBinaryProtocol()
+        p.submit_deserialised_many(((i,) for i in range(3)))
+        for i in range(3):
+            self.assertEqual(p.get_next_deserialised(), (i,))
+        self.assertIsNone(p.get_next_deserialised())
+
+    def test_serialised_overflow_drops_oldest(self):
+        p = BaseBinaryProtocol()
+        for i in range(_MAX_QUEUE_LEN + 1):
+            p.submit_serialised(bytes([i]))
+        self.assertEqual(p.get_next_serialised(), bytes([1]))
+
 
 class TestStringBinaryProtocol(TestCase):
     def test_serialise_hello(self):
@@ -53,6 +78,18 @@ class TestStringBinaryProtocol(TestCase):
             p.process_values(('ß',))
         self.assertIsNone(p.get_next_serialised())
 
+    def test_serialise_invalid_ascii_character_replace(self):
+        p = StringBinaryProtocol(encoding='ascii', encode_errors='replace')
+        p.process_values(('aßb',))
+        self.assertEqual(p.get_next_serialised(), b'a?b')
+
+    def test_deserialise_invalid_utf8_code_replace(self):
+        p = StringBinaryProtocol(decode_errors='replace')
+        p.process_data(b'a\xffb\xc3')
+        self.assertEqual(p.get_next_deserialised(), ('a\ufffdb',))
+        p.process_data(b'\x9f')
+        self.assertEqual(p.get_next_deserialised(), ('ß',))
+
     def test_deserialise_invalid_utf8_code(self):
         p = StringBinaryProtocol()
         with self.assertLogs(logger, 'ERROR'):
@@ -60,6 +97,12 @@ class TestStringBinaryProtocol(TestCase):
         self.assertEqual(p.get_next_deserialised(), ('a',))
         self.assertEqual(p.get_next_deserialised(), ('b',))
 
+    def test_deserialise_invalid_utf8_code_logs_reason(self):
+        p = StringBinaryProtocol()
+        with self.assertLogs(logger, 'ERROR') as cm:
+            p.process_data(b'a\xc3b')
+        self.assertIn("can't decode byte 0xc3", cm.output[0])
+
     def test_deserialise_ss_over_2_calls_at_start(self):
         p = StringBinaryProtocol()
 
@@ -81,3 +124,232 @@ class TestStringBinaryProtocol(TestCase):
         # Process second half of 'ß' and 'b'.
         p.process_data(b'\x9fb')
         self.assertEqual(p.get_next_deserialised(), ('ßb',))
+
+    def test_deserialise_ascii_after_pending(self):
+        p = StringBinaryProtocol()
+        p.process_data(b'a\xc3')
+        self.assertEqual(p.get_next_deserialised(), ('a',))
+
+        # ASCII data must not bypass the pending byte, which is now invalid.
+        with self.assertLogs(logger, 'ERROR'):
+            p.process_data(b'b')
+        self.assertEqual(p.get_next_deserialised(), ('b',))
+        self.assertIsNone(p.get_next_deserialised())
+
+    def test_deserialise_4_byte_character_over_3_calls(self):
+        p = StringBinaryProtocol()
+        p.process_data(b'\xf0\x9f')
+        p.process_data(b'\x98')
+        self.assertIsNone(p.get_next_deserialised())
+        p.process_data(b'\x80')
+        self.assertEqual(p.get_next_deserialised(), ('\U0001f600',))
+
+    def test_deserialise_invalid_pending_data_logs_bytes(self):
+        p = StringBinaryProtocol(encoding='shift_jis')
+        p.process_data(b'\x81')
+        with self.assertLogs(logger, 'ERROR') as cm:
+            p.process_data(b'\x20')
+        self.assertIn("failed to decode b'\\x81'", cm.output[0])
+
+    def test_deserialise_multiple_invalid_utf8_codes(self):
+        p = StringBinaryProtocol()
+        with self.assertLogs(logger, 'ERROR') as cm:
+            p.process_data(b'a\xffb\xfe\xfdc')
+        self.assertEqual(len(cm.output), 3)
+        self.assertEqual(p.get_next_deserialised(), ('a',))
+        self.assertEqual(p.get_next_deserialised(), ('b',))
+        self.assertEqual(p.get_next_deserialised(), ('c',))
+        self.assertIsNone(p.get_next_deserialised())
+
+    def test_serialise_cp1252(self):
+        p = StringBinaryProtocol(encoding='cp1252')
+        p.process_values(('€',))
+        self.assertEqual(p.get_next_serialised(), b'\x80')
+
+    def test_deserialise_cp1252(self):
+        p = StringBinaryProtocol(encoding='cp1252')
+        p.process_data(b'\x80')
+        self.assertEqual(p.get_next_deserialised(), ('€',))
+
+    def test_deserialise_multibyte_encodings_one_byte_at_a_time(self):
+        for encoding in ('shift_jis', 'gb18030', 'utf-16-le'):
+            for errors in ('strict', 'replace'):
+                with self.subTest(encoding=encoding, errors=errors):
+                    p = StringBinaryProtocol(encoding=encoding,
+                                             decode_errors=errors)
+                    data = 'aあ中'.encode(encoding)
+                    out = []
+                    for i in range(len(data)):
+                        p.process_data(data[i:i + 1])
+                        values = p.get_next_deserialised()
+                        while values is not None:
+                            out.append(values[0])
+                            values = p.get_next_deserialised()
+                    self.assertEqual(''.join(out), 'aあ中')
+
+    def test_encoding_alias(self):
+        p = StringBinaryProtocol(encoding='U8')
+        self.assertEqual(p.encoding, 'U8')
+        p.process_values(('ß',))
+        self.assertEqual(p.get_next_serialised(), b'\xc3\x9f')
+        p.process_data(b'\xc3\x9f')
+        self.assertEqual(p.get_next_deserialised(), ('ß',))
+
+    def test_unknown_encoding(self):
+        with self.assertRaises(LookupError):
+            StringBinaryProtocol(encoding='not-an-encoding')
+
+    def test_deserialise_euro_over_2_calls_with_invalid_byte(self):
+        p = StringBinaryProtocol()
+        with self.assertLogs(logger, 'ERROR'):
+            p.process_data(b'\xffa\xe2\x82')
+        self.assertEqual(p.get_next_deserialised(), ('a',))
+        self.assertIsNone(p.get_next_deserialised())
+        p.process_data(b'\xac')
+        self.assertEqual(p.get_next_deserialised(), ('€',))
+
+
+class TestUtf8CompleteLen(TestCase):
+    def test_empty(self):
+        self.assertEqual(_utf8_complete_len(b''), 0)
+
+    chars = ['ß'.encode(), '€'.encode(), '\U0001f600'.encode()]
+
+    def test_complete(self):
+        for data in [b'a'] + self.chars:
+            with self.subTest(data=data):
+                self.assertEqual(_utf8_complete_len(b'a' + data),
+                                 len(data) + 1)
+
+    def test_incomplete(self):
+        for data in self.chars:
+            for cut in range(1, len(data)):
+                with self.subTest(data=data, cut=cut):
+                    self.assertEqual(_utf8_complete_len(b'a' + data[:cut]), 1)
+
+    def test_invalid_left_to_decoder(self):
+        for data in (b'a\xff', b'a\x80', b'\x80\x80\x80\x80', b'a\xc0'):
+            with self.subTest(data=data):
+                self.assertEqual(_utf8_complete_len(data), len(data))
+
+
+class TestFixedLengthBinaryProtocol(TestCase):
+    fields = [('uint', 2), ('int', 1), ('float', 4), ('bytes', 3)]
+    values = (0x1234, -1, 0.5, b'abc')
+    data = b'\x12\x34\xff\x3f\x00\x00\x00abc'
+
+    def test_size(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        self.assertEqual(p.size, 10)
+
+    def test_zero_length(self):
+        for fields in ([], [('bytes', 0)]):
+            with self.subTest(fields=fields):
+                with self.assertRaises(ValueError):
+                    FixedLengthBinaryProtocol(fields)
+
+    def test_serialise(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        self.assertEqual(p.serialise(self.values), self.data)
+
+    def test_serialise_into(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        buf = bytearray(2 * p.size)
+        p.serialise_into(buf, p.size, self.values)
+        self.assertEqual(buf, bytes(p.size) + self.data)
+
+    def test_deserialise(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        self.assertEqual(p.deserialise(self.data), self.values)
+
+    def test_deserialise_with_offset(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        self.assertEqual(p.deserialise(b'xx' + self.data, 2), self.values)
+
+    def test_process_values(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        p.process_values(self.values)
+        self.assertEqual(p.get_next_serialised(), self.data)
+
+    def test_process_values_wrong_length(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        with self.assertRaises(ValueError):
+            p.process_values((1, 2))
+
+    def test_process_values_out_of_range(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        with self.assertLogs(logger, 'ERROR'):
+            p.process_values((0x10000, -1, 0.5, b'abc'))
+        self.assertIsNone(p.get_next_serialised())
+
+    def test_process_data_multiple_messages(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        p.process_data(self.data * 2)
+        self.assertEqual(p.get_next_deserialised(), self.values)
+        self.assertEqual(p.get_next_deserialised(), self.values)
+        self.assertIsNone(p.get_next_deserialised())
+
+    def test_process_data_multiple_messages_with_pending(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        p.process_data(self.data[:5])
+        p.process_data(self.data[5:] + self.data * 2 + self.data[:1])
+        for _ in range(3):
+            self.assertEqual(p.get_next_deserialised(), self.values)
+        self.assertIsNone(p.get_next_deserialised())
+        p.process_data(self.data[1:])
+        self.assertEqual(p.get_next_deserialised(), self.values)
+
+    def test_process_data_over_3_calls(self):
+        p = FixedLengthBinaryProtocol(self.fields)
+        p.process_data(self.data[:4])
+        p.process_data(self.data[4:8])
+        self.assertIsNone(p.get_next_deserialised())
+        p.process_data(self.data[8:] + self.data[:1])
+        self.assertEqual(p.get_next_deserialised(), self.values)
+        self.assertIsNone(p.get_next_deserialised())
+        p.process_data(self.data[1:])
+        self.assertEqual(p.get_next_deserialised(), self.values)
+
+    def test_non_native_length_integers(self):
+        p = FixedLengthBinaryProtocol([('int', 3), ('uint', 5)])
+        data = b'\xff\xff\xfe\x01\x00\x00\x00\x00'
+        self.assertEqual(p.serialise((-2, 2 ** 32)), data)
+        self.assertEqual(p.deserialise(data), (-2, 2 ** 32))
+        p.process_data(data)
+        self.assertEqual(p.get_next_deserialised(), (-2, 2 ** 32))
+
+    def test_single_non_native_length_integer(self):
+        p = FixedLengthBinaryProtocol([('uint', 3)])
+        self.assertEqual(p.serialise((1,)), b'\x00\x00\x01')
+        self.assertEqual(p.deserialise(b'\x00\x00\x01'), (1,))
+
+    def test_non_native_length_integer_too_many_values(self):
+        p = FixedLengthBinaryProtocol([('uint', 3)])
+        with self.assertRaises(struct.error):
+            p.serialise((1, 2))
+
+    def test_non_native_length_integer_too_few_values(self):
+        p = FixedLengthBinaryProtocol([('uint', 2), ('uint', 3)])
+        with self.assertRaises(struct.error):
+            p.serialise((1,))
+        with self.assertRaises(struct.error):
+            p.serialise_into(bytearray(p.size), 0, (1,))
+
+    def test_non_native_length_integer_out_of_range(self):
+        p = FixedLengthBinaryProtocol([('uint', 3)])
+        with self.assertLogs(logger, 'ERROR'):
+            p.process_values((2 ** 24,))
+        self.assertIsNone(p.get_next_serialised())
+
+    def test_non_native_length_integer_wrong_type(self):
+        for value in ('a', 1.5, None):
+            with self.subTest(value=value):
+                p = FixedLengthBinaryProtocol([('uint', 3)])
+                with self.assertLogs(logger, 'ERROR'):
+                    p.process_values((value,))
+                self.assertIsNone(p.get_next_serialised())
+
+    def test_struct_shared_between_instances(self):
+        p1 = FixedLengthBinaryProtocol(self.fields)
+        p2 = FixedLengthBinaryProtocol([list(f) for f in self.fields])
+        self.assertIs(p1._struct, p2._struct)